@@ -1,14 +1,20 @@
-from typing import Optional, Dict
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from typing import Optional, Dict, List, Tuple
 
 from requests import RequestException
 
-from redash_client import Dashboard, DataSource, User, Group, Widget, Query, DataSourceOptions
+from redash_client import Dashboard, DataSource, User, Group, Widget, Query, DataSourceOptions, Visualization, \
+    redash_client
 
 DEFAULT_GROUP_PERMISSIONS = '{create_dashboard,create_query,edit_dashboard,edit_query,view_query,view_source,' \
                             'execute_query,list_users,schedule_query,list_dashboards,list_alerts,list_data_sources}'
 MERCHANT_GROUP_PERMISSIONS = '{edit_dashboard,view_query,execute_query,schedule_query,list_dashboards,list_alerts,' \
                              'list_data_sources}'
 DASHBOARD_PREFIX = 'Dashboard - '
+CLONE_WIDGETS_MAX_WORKERS = 8
 SHOP_ID_SUFFIX = ' ({})'
 ARCHIVE_OLD_QUERIES_AND_DASHBOARDS_SQL = """
 update queries set is_archived=TRUE where data_source_id is null and is_archived=FALSE;
@@ -21,6 +27,14 @@ update dashboards set is_archived=TRUE where id in (
     where dashboards.is_archived=FALSE and q.is_archived = true);
 """
 
+logger = logging.getLogger(__name__)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('[#]  %(message)s'))
+logger.addHandler(_log_handler)
+logger.setLevel(logging.INFO)
+# The logger has its own handler, so its messages aren't passed on to the root logger's handlers as well
+logger.propagate = False
+
 
 class GenerateDashboard:
     """
@@ -40,13 +54,19 @@ class GenerateDashboard:
     redash_postgres_client = None  # TODO: Need to use an open source postgres client
 
     def __init__(self):
-        self.queries_cache: Dict[int, Query] = {}
-        self.data_sources_cache: Dict[int, DataSource] = {}
+        self.original_queries_cache: Dict[int, Query] = {}
+        self.queries_cache: Dict[int, Future[Query]] = {}
+        # New query id -> visualization key (see visualization_key) -> visualization id
+        self.visualizations_ids_cache: Dict[int, Dict[Tuple[str, str, str], int]] = {}
+        self.queries_cache_lock = Lock()
+        self.data_sources_cache: Optional[Dict[int, DataSource]] = None
+        self.groups_cache: Optional[List[Group]] = None
         self.new_data_source_id = None
 
     @staticmethod
     def print_log(msg: str):
-        print(f'[#]  {msg}')
+        # Widgets are cloned from worker threads, so we log through a logger instead of print to avoid interleaving
+        logger.info(msg)
 
     def run(self):
         if not self.dashboard_template_slug_name and not self.dashboard_template_shop_name:
@@ -66,9 +86,11 @@ class GenerateDashboard:
         new_users_list = []
         existing_users = []
         if self.users_data:
+            # Fetch all the existing users once, instead of searching for each user that already exists
+            existing_users_by_email = {user.email: user for user in User.objects()}
             for user_data in self.users_data.split(";"):
                 email, name = [field.strip() for field in user_data.split(',')]
-                user, created = self.get_or_create_user(email, name)
+                user, created = self.get_or_create_user(email, name, existing_users_by_email)
                 (new_users_list if created else existing_users).append(user)
 
         # Create group and data source
@@ -79,8 +101,7 @@ class GenerateDashboard:
         redshift_data_source_id = self.create_data_source(formatted_name).id
 
         # Add data source to group
-        group.add_data_source(redshift_data_source_id)
-        group.set_data_source_access(redshift_data_source_id)
+        group.add_data_source(redshift_data_source_id, view_only=True)
 
         self.print_log(f'Added data source to group')
 
@@ -101,11 +122,18 @@ class GenerateDashboard:
 
         self.new_data_source_id = redshift_data_source_id
 
-    def get_or_create_user(self, email: str, name: str) -> (User, bool):
+    def get_or_create_user(self, email: str, name: str,
+                           existing_users_by_email: Dict[str, User] = None) -> (User, bool):
         """
         Get an existing user or creates a new one.
         Returns a tuple of (user, created)
+        @param existing_users_by_email: Optionally, already fetched users by their email, to look the user up in
         """
+        existing_user = (existing_users_by_email or {}).get(email)
+        if existing_user:
+            self.print_log(f'Found existing user. id: {existing_user.id}')
+            return existing_user, False
+
         new_user = User(name=name, email=email)
         try:
             new_user.save()
@@ -122,13 +150,17 @@ class GenerateDashboard:
             raise
 
     def get_or_create_group(self, group_name: str) -> Group:
-        for group in Group.objects():
+        if self.groups_cache is None:
+            self.groups_cache = Group.objects()
+
+        for group in self.groups_cache:
             if group.name == group_name:
                 self.print_log(f'Found existing group. id: {group.id}')
                 return group
 
         group = Group(name=group_name)
         group.save()
+        self.groups_cache.append(group)
         self.print_log(f'Created new group. id: {group.id}')
         return group
 
@@ -144,18 +176,29 @@ class GenerateDashboard:
         if options:
             new_data_source.options = options
 
+        # The data sources are fetched once and then kept up to date with the changes made here, instead of being
+        # fetched again for each new data source
+        if self.data_sources_cache is None:
+            self.data_sources_cache = {data_source.id: data_source for data_source in DataSource.objects()}
+
         new_data_source.save()
+        self.data_sources_cache[new_data_source.id] = new_data_source
         self.print_log(f'Created new data source (id: {new_data_source.id})')
 
-        for data_source in DataSource.objects():
+        for data_source in list(self.data_sources_cache.values()):
             if data_source.id != new_data_source.id and data_source.name == data_source_name:
                 data_source.delete()
+                del self.data_sources_cache[data_source.id]
                 self.print_log(f'Deleted duplicate data source (id: {data_source.id})')
 
         return new_data_source
 
     def set_group_permissions(self, group_id, permissions=DEFAULT_GROUP_PERMISSIONS):
-        self.redash_postgres_client.execute_only(f"UPDATE groups SET permissions='{permissions}' where id={group_id}")
+        permissions = permissions.replace("'", "''")
+        self.redash_postgres_client.execute_only(
+            f"UPDATE groups SET permissions='{permissions}' where id={int(group_id)}")
+        # The change is made directly in redash's database, so the api client doesn't know it to invalidate its cache
+        redash_client.invalidate_cache('groups')
 
     def clone_dashboard(self):
         if self.dashboard_template_slug_name:
@@ -182,32 +225,45 @@ class GenerateDashboard:
         new_dashboard = Dashboard(
             name=original_dashboard.name.replace(self.dashboard_template_shop_name, self.shop_name, 1))
 
+        self.fetch_original_queries(original_dashboard.widgets)
+
         new_dashboard.save()
         self.print_log(f'Created new dashboard. id: {new_dashboard.id}, slug: {new_dashboard.slug}\n')
 
-        for widget in original_dashboard.widgets:
-            self.clone_widget(widget, new_dashboard.id)
+        # Each widget is cloned independently (and each clone is a few blocking requests), so we clone them concurrently
+        with ThreadPoolExecutor(max_workers=CLONE_WIDGETS_MAX_WORKERS) as executor:
+            list(executor.map(lambda widget: self.clone_widget(widget, new_dashboard.id), original_dashboard.widgets))
 
         new_dashboard.dashboard_filters_enabled = True
         new_dashboard.is_draft = False
         new_dashboard.save()
 
+    def fetch_original_queries(self, widgets: List[Widget]):
+        """
+        Fetches the full data of all the queries used by the widgets concurrently (each query once, even if it's used by
+        several widgets) before cloning the widgets
+        """
+        for widget in widgets:
+            query = widget.visualization.query
+            self.original_queries_cache.setdefault(query.id, query)
+
+        with ThreadPoolExecutor(max_workers=CLONE_WIDGETS_MAX_WORKERS) as executor:
+            list(executor.map(Query.fetch, self.original_queries_cache.values()))
+
+        self.print_log(f'Fetched original queries. count: {len(self.original_queries_cache)}')
+
     def clone_widget(self, widget: Widget, new_dashboard_id: int):
         self.print_log(
             f'Cloning widget. id: {widget.id}, name: {widget.visualization.query.name} - {widget.visualization.name}')
         original_visualization = widget.visualization
-        original_query = original_visualization.query
-        original_query.fetch()
+        original_query = self.original_queries_cache[original_visualization.query.id]
 
         new_query = self.get_or_create_new_query(original_query)
 
-        for visualization in new_query.visualizations:
-            if visualization.name == original_visualization.name and \
-                    visualization.type == original_visualization.type and \
-                    visualization.options == original_visualization.options:
-                widget.visualization_id = visualization.id
-                break
-        else:
+        try:
+            widget.visualization_id = \
+                self.visualizations_ids_cache[new_query.id][self.visualization_key(original_visualization)]
+        except KeyError:
             raise Exception('Could not find matching visualization on new query')
 
         widget.visualization = None
@@ -217,24 +273,53 @@ class GenerateDashboard:
         self.print_log(f'Created new widget. id: {widget.id}\n')
 
     def get_or_create_new_query(self, original_query: Query) -> Query:
-        new_query = self.queries_cache.get(original_query.id)
-        if not new_query:
-            new_query = original_query.fork()
-            self.print_log(f'Forked query. existing_id: {original_query.id}, new_id: {new_query.id}')
-            new_query.name = original_query.name.replace(self.dashboard_template_shop_name, self.shop_name, 1)
-
-            # Replace shop ids to the target shop ids
-            new_query.query = original_query.query \
-                .replace(str(self.dashboard_template_shop_id), str(self.shop_id))
-
-            new_query.data_source_id = self.new_data_source_id
-
-            new_query.is_draft = False
-            new_query.save()
-            self.queries_cache[original_query.id] = new_query
+        # Each original query is mapped to a future of its new query, so that widgets sharing a query (cloned
+        # concurrently) wait for a single fork, while forks of different queries still run concurrently
+        with self.queries_cache_lock:
+            new_query_future = self.queries_cache.get(original_query.id)
+            should_fork = new_query_future is None
+            if should_fork:
+                new_query_future = self.queries_cache[original_query.id] = Future()
+
+        if should_fork:
+            try:
+                new_query_future.set_result(self.fork_query(original_query))
+            except Exception as e:
+                new_query_future.set_exception(e)
+
+        return new_query_future.result()
+
+    def fork_query(self, original_query: Query) -> Query:
+        new_query = original_query.fork()
+        self.print_log(f'Forked query. existing_id: {original_query.id}, new_id: {new_query.id}')
+        new_query.name = original_query.name.replace(self.dashboard_template_shop_name, self.shop_name, 1)
+
+        # Replace shop ids to the target shop ids
+        new_query.query = original_query.query \
+            .replace(str(self.dashboard_template_shop_id), str(self.shop_id))
+
+        new_query.data_source_id = self.new_data_source_id
+
+        new_query.is_draft = False
+        new_query.save()
+
+        # Widgets find their visualization on the new query by this index, instead of comparing with each visualization.
+        # If several visualizations have the same key, the first one is used
+        visualizations_ids = self.visualizations_ids_cache[new_query.id] = {}
+        for visualization in new_query.visualizations:
+            visualizations_ids.setdefault(self.visualization_key(visualization), visualization.id)
 
         return new_query
 
+    @staticmethod
+    def visualization_key(visualization: Visualization) -> Tuple[str, str, str]:
+        """
+        Returns a key for matching visualizations by their name, type and options. The options are dumped with sorted
+        keys, so equal options have the same key
+        """
+        return visualization.name, visualization.type, json.dumps(visualization.options, sort_keys=True)
+
     def archive_old_queries_and_dashboards(self):
         self.print_log('Archiving old queries and dashboards')
         self.redash_postgres_client.execute_only(ARCHIVE_OLD_QUERIES_AND_DASHBOARDS_SQL)
+        redash_client.invalidate_cache('queries', 'dashboards')
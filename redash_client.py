@@ -1,15 +1,32 @@
+import os
 import re
 from datetime import datetime
 from abc import ABC, abstractmethod
 from typing import Optional, Union, Any, TypeVar, ClassVar, Type, Iterator
 from typing_extensions import Protocol
 from dataclasses import field
-from functools import partialmethod
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 import requests
+from requests.adapters import HTTPAdapter
 import backoff
 from marshmallow_dataclass import dataclass, NewType
-from marshmallow import Schema, fields, ValidationError
+from marshmallow import Schema, fields, ValidationError, RAISE
+
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:  # orjson is optional, it's only used since it's faster
+    import json
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+    _json_loads = json.loads
 
 REDASH_BASE_URL = ''
 REDASH_API_KEY = ''
@@ -19,9 +36,18 @@ REDSHIFT_USER = ''
 REDSHIFT_PASSWORD = ''
 REDSHIFT_DBNAME = ''
 
+# Dumped entities are only validated against their schema when debugging (set REDASH_ORM_VALIDATE to enable it)
+VALIDATE_DUMPS = bool(os.environ.get('REDASH_ORM_VALIDATE'))
+
+# GET responses are cached on disk for this many seconds when set (set REDASH_ORM_CACHE_SECONDS to enable it), which
+# requires requests-cache
+RESPONSES_CACHE_EXPIRE_SECONDS = int(os.environ.get('REDASH_ORM_CACHE_SECONDS') or 0) or None
+
 Jsondict = dict[str, Any]
 JsonValue = Union[Jsondict, list[Jsondict]]
 
+CAMEL_CASE_WORD_BOUNDARY_RE = re.compile(r'(?<!^)(?=[A-Z])')
+
 Email = NewType("Email", str, field=fields.Email)
 
 
@@ -29,34 +55,6 @@ class IsDataclass(Protocol):
     __dataclass_fields__: dict
 
 
-Leaf = tuple[list[str], Any]
-
-
-def _get_leaves(obj, current_path: list[str] = None) -> Optional[list[Leaf]]:
-    """
-    Returns a list of Leaves, each is a tuple of the path to the leaf and the leaf's value.
-    e.g: {'a': {'b': 1, 'c': 2}} -> [(['a', 'b'], 1), (['a', 'c'], 2)]
-    """
-    if not isinstance(obj, dict):
-        return None
-
-    current_path = current_path or []
-    paths = []
-    for key, value in obj.items():
-        item_path = current_path + [key]
-        result = _get_leaves(value, item_path)
-        if result is None:
-            paths.append((item_path, value))
-        elif isinstance(result, list):
-            paths += result
-
-    return paths
-
-
-def get_leaves(obj) -> list[Leaf]:
-    return _get_leaves(obj) or []
-
-
 def pop_leaf(obj, path: list[str]):
     """
     Removes a leaf from an object in the given path
@@ -79,8 +77,72 @@ def add_leaf(obj, path, value):
     obj[path[-1]] = value
 
 
+def _get_nested_schema(field: fields.Field) -> Optional[tuple[Schema, bool]]:
+    """
+    Returns the schema a field loads its value with and whether the value is a list, or None if it's not nested
+    """
+    if isinstance(field, fields.Nested):
+        return field.schema, field.many
+
+    if isinstance(field, fields.List) and isinstance(field.inner, fields.Nested):
+        return field.inner.schema, True
+
+    return None
+
+
+@lru_cache(maxsize=None)
+def _get_load_fields_by_key(schema: Schema) -> dict[str, Optional[tuple[Schema, bool]]]:
+    """
+    Returns the keys a schema loads, each with its nested schema (see _get_nested_schema).
+    This is computed once per schema instance, since the models' schemas (and their nested schemas) are singletons
+    """
+    return {field.data_key or name: _get_nested_schema(field) for name, field in schema.load_fields.items()}
+
+
+def get_unknown_fields_paths(schema: Schema, obj: JsonValue, many: bool = False,
+                             unknown: Optional[str] = None) -> list[list[Union[str, int]]]:
+    """
+    Returns the paths of all the fields in the object that are unknown to the schema (or its nested schemas), in the
+    same form marshmallow reports them (list items by their index)
+    e.g: {'a': 1, 'b': [{'c': 2}]} with a schema that only has 'b', which has no 'c' -> [['a'], ['b', 0, 'c']]
+    Like marshmallow, only schemas that raise on unknown fields are checked (the schema's `unknown` option, which can
+    be overridden for the top level schema with `unknown`), so these are exactly the fields marshmallow would reject
+    """
+    stack = [(schema, obj, (), many, unknown or schema.unknown)]
+    paths = []
+    while stack:
+        schema, value, path, many, unknown = stack.pop()
+        if many:
+            if isinstance(value, list):
+                stack.extend((schema, item, path + (index,), False, unknown) for index, item in enumerate(value))
+
+            continue
+
+        if not isinstance(value, dict):
+            continue
+
+        check_unknown = unknown == RAISE
+
+        load_fields_by_key = _get_load_fields_by_key(schema)
+        for key, item in value.items():
+            if key not in load_fields_by_key:
+                if check_unknown:
+                    paths.append(list(path + (key,)))
+
+                continue
+
+            nested_schema = load_fields_by_key[key]
+            if nested_schema:
+                stack.append((nested_schema[0], item, path + (key,), nested_schema[1], nested_schema[0].unknown))
+
+    return paths
+
+
 def _should_give_up(error: requests.exceptions.RequestException):
-    return error.response.status_code < 500
+    """
+    Gives up on client errors (4xx). Errors without a response (e.g connection errors and timeouts) are retried
+    """
+    return error.response is not None and error.response.status_code < 500
 
 
 class RedashApiClient:
@@ -90,11 +152,54 @@ class RedashApiClient:
     PUT = 'PUT'
     PATCH = 'PATCH'
 
-    def __init__(self, base_url: str, api_key: str, timeout_seconds: Optional[int] = 30) -> None:
+    # A change to an entity also changes the responses of these entities, so their cached responses are invalidated too
+    CACHE_DEPENDENCIES = {
+        'groups': ('users', 'data_sources'),  # users and data sources list the groups they're in
+        'users': ('groups',),  # the users' groups list them as members
+        'data_sources': ('groups', 'queries', 'dashboards'),  # deleting a data source deletes its queries (and widgets)
+        'queries': ('dashboards',),  # dashboards include their widgets' queries
+        'widgets': ('dashboards',),
+    }
+    CACHE_URL_ENTITY_RE = re.compile(r'[/?]')
+
+    def __init__(self, base_url: str, api_key: str, timeout_seconds: Optional[int] = 30,
+                 pool_connections: int = 16, pool_maxsize: int = 32,
+                 cache_expire_seconds: Optional[int] = None) -> None:
+        """
+        :param cache_expire_seconds: Optionally, cache GET responses on disk (in redash.sqlite) for this many seconds
+        (requires requests-cache>=1.0). Any other request invalidates the cached responses of the entity it changes and
+        of the entities that depend on it (see CACHE_DEPENDENCIES). Changes made outside the API (e.g directly in
+        redash's database) aren't known to the cache, so they should be followed by invalidate_cache, otherwise the
+        affected responses may be stale until they expire
+        """
         self.base_url = base_url
         self.headers = {'Authorization': 'Key {api_key}'.format(api_key=api_key),
                         'Content-Type': 'application/json'}
         self.timeout_seconds = timeout_seconds
+        self.cache_enabled = bool(cache_expire_seconds)
+
+        # A single session is reused for all requests, so connections are kept alive instead of opened per request.
+        # Retries are handled by backoff in _request, so the adapter itself doesn't retry.
+        if self.cache_enabled:
+            import requests_cache  # requests-cache is only required when caching is enabled
+
+            self._session = requests_cache.CachedSession(
+                cache_name='redash', backend='sqlite', expire_after=cache_expire_seconds, allowable_methods=[self.GET])
+
+            # The cached urls are indexed by their entity once (after removing the expired responses), so invalidating
+            # an entity doesn't read the whole cache
+            self._session.cache.delete(expired=True)
+            self._cached_urls_lock = Lock()
+            self._cached_urls_by_entity: dict[str, set[str]] = {}
+            for url in self._session.cache.urls():
+                self._add_cached_url(url)
+        else:
+            self._session = requests.Session()
+
+        self._session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
 
     def _url(self, endpoint: str) -> str:
         """Return the full URL for upcoming request
@@ -104,30 +209,87 @@ class RedashApiClient:
         """
         return f'{self.base_url}/api/{endpoint}'
 
+    def _add_cached_url(self, url: str):
+        """Index a cached url by its entity (the first part of its endpoint), e.g 'groups/1/members' -> 'groups'
+
+        :param url: url of a cached response
+        """
+        api_url = self._url('')
+        if not url.startswith(api_url):
+            return
+
+        entity = self.CACHE_URL_ENTITY_RE.split(url[len(api_url):], 1)[0]
+        with self._cached_urls_lock:
+            self._cached_urls_by_entity.setdefault(entity, set()).add(url)
+
+    def invalidate_cache(self, *entities: str):
+        """Remove the cached responses of the given entities: their lists (with any params), their objects and their sub
+        endpoints. e.g: 'groups' -> 'groups?page=2', 'groups/1', 'groups/2/members', ...
+
+        :param entities: the entities' names, as in their endpoints (e.g 'groups')
+        """
+        if not self.cache_enabled:
+            return
+
+        with self._cached_urls_lock:
+            urls = [url for entity in entities for url in self._cached_urls_by_entity.pop(entity, ())]
+
+        if urls:
+            self._session.cache.delete(urls=urls)
+
     @backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_tries=3, giveup=_should_give_up)
     def _request(self, endpoint: str, method: str, **kwargs) -> Optional[JsonValue]:
-        res = requests.request(method=method, url=self._url(endpoint), headers=self.headers,
-                               timeout=self.timeout_seconds, **kwargs)
+        # The json is (de)serialized here instead of by requests, so orjson is used when it's installed
+        json_data = kwargs.pop('json', None)
+        if json_data is not None:
+            kwargs['data'] = _json_dumps(json_data)
+
+        res = self._session.request(method=method, url=self._url(endpoint), timeout=self.timeout_seconds, **kwargs)
 
         res.raise_for_status()
-        return res.json() if res.content else None
+        if self.cache_enabled:
+            if method == self.GET:
+                self._add_cached_url(res.url)
+            else:
+                entity = endpoint.split('/', 1)[0]
+                self.invalidate_cache(entity, *self.CACHE_DEPENDENCIES.get(entity, ()))
+
+        return _json_loads(res.content) if res.content else None
+
+    def get(self, endpoint: str, **kwargs) -> Optional[JsonValue]:
+        return self._request(endpoint, self.GET, **kwargs)
 
-    get = partialmethod(_request, method=GET)
-    post = partialmethod(_request, method=POST)
-    put = partialmethod(_request, method=PUT)
-    delete = partialmethod(_request, method=DELETE)
-    patch = partialmethod(_request, method=PATCH)
+    def post(self, endpoint: str, **kwargs) -> Optional[JsonValue]:
+        return self._request(endpoint, self.POST, **kwargs)
 
+    def put(self, endpoint: str, **kwargs) -> Optional[JsonValue]:
+        return self._request(endpoint, self.PUT, **kwargs)
+
+    def delete(self, endpoint: str, **kwargs) -> Optional[JsonValue]:
+        return self._request(endpoint, self.DELETE, **kwargs)
+
+    def patch(self, endpoint: str, **kwargs) -> Optional[JsonValue]:
+        return self._request(endpoint, self.PATCH, **kwargs)
+
+
+# Used by IterableRedashEntity.objects to get the next page while the current one is being consumed
+_pagination_executor = ThreadPoolExecutor(max_workers=2)
 
 redash_client = RedashApiClient(
     base_url=REDASH_BASE_URL,
-    api_key=REDASH_API_KEY
+    api_key=REDASH_API_KEY,
+    cache_expire_seconds=RESPONSES_CACHE_EXPIRE_SECONDS
 )
 
 T = TypeVar('T', bound=IsDataclass)
 
 
 class Entitylist(list):
+    """
+    A list of loaded entities with unknown fields. Plain lists are returned when there are no unknown fields
+    """
+    __slots__ = ('_unknown_fields',)
+
     _unknown_fields: list
 
 
@@ -202,17 +364,20 @@ class RedashEntity:
 
         # if a model didn't define a base_endpoint, we use the model's name in snake_case in plural as the base_endpoint
         if not hasattr(cls, 'base_endpoint') and ABC not in cls.__bases__:
-            cls.base_endpoint = re.sub(r'(?<!^)(?=[A-Z])', '_', cls.__name__).lower() + 's'
+            cls.base_endpoint = CAMEL_CASE_WORD_BOUNDARY_RE.sub('_', cls.__name__).lower() + 's'
 
     @classmethod
     def schema(cls) -> Schema:
         """
-        A singleton for the model's schema instance
+        A singleton for the model's schema instance.
+        The schema is looked up in the class' own __dict__, since hasattr would also find a schema cached on a parent
+        model (when a model subclasses another model) and return the wrong one
         """
-        if not hasattr(cls, '_schema'):
-            cls._schema = cls.Schema()
+        schema = cls.__dict__.get('_schema')
+        if schema is None:
+            cls._schema = schema = cls.Schema()
 
-        return cls._schema
+        return schema
 
     @classmethod
     def _load(cls: Type[T], obj: JsonValue, **kwargs) -> Union[T, list[T]]:
@@ -221,27 +386,16 @@ class RedashEntity:
         If any unknown fields are found, they are saved aside for when we dump the object to preserve it's original
         fields
         """
-        try:
-            entity = cls.schema().load(obj, **kwargs)
-        except ValidationError as validation_error:
-            # If we ran into validation errors, we want to use all the 'Unknown field' errors to save the unknown
-            # fields aside, and raise the rest of the errors (if any)
-            errors = validation_error.messages
-            raise_validation_errors = False
-
-            unknown_fields_paths = []
-            for error_path, error in get_leaves(errors):
-                if error == ['Unknown field.']:
-                    unknown_fields_paths.append(error_path)
-                    pop_leaf(errors, error_path)
-                else:
-                    raise_validation_errors = True
-
-            if raise_validation_errors:
-                raise ValidationError(errors)
+        schema = cls.schema()
+
+        # The unknown fields are found by walking the object along the schema and removed before loading it, so the
+        # object is loaded only once (instead of loading it, collecting the 'Unknown field' errors and loading again)
+        unknown_fields_paths = get_unknown_fields_paths(schema, obj, many=kwargs.get('many', schema.many),
+                                                        unknown=kwargs.get('unknown'))
+        unknown_fields = [(path, pop_leaf(obj, path)) for path in unknown_fields_paths]
 
-            unknown_fields = [(path, pop_leaf(obj, path)) for path in unknown_fields_paths]
-            entity = cls.schema().load(obj, **kwargs)
+        entity = schema.load(obj, **kwargs)
+        if unknown_fields:
             if isinstance(entity, list):
                 entity = Entitylist(entity)
 
@@ -259,15 +413,16 @@ class RedashEntity:
 
     def dump(self) -> JsonValue:
         """
-        Dumps an object using the model's schema and the validates it.
+        Dumps an object using the model's schema, and validates it if VALIDATE_DUMPS is set.
         If the object has any unknown fields that where found when it was loaded, they are added to the result json
         """
         json_value = self.schema().dump(self)
-        errors = self.schema().validate(json_value)
-        if errors:
-            raise ValidationError(errors)
+        if VALIDATE_DUMPS:
+            errors = self.schema().validate(json_value)
+            if errors:
+                raise ValidationError(errors)
 
-        for field_path, value in getattr(self, '_unknown_fields', {}):
+        for field_path, value in getattr(self, '_unknown_fields', ()):
             add_leaf(json_value, field_path, value)
 
         return json_value
@@ -348,15 +503,30 @@ class IterableRedashEntity(ABC, RedashEntity):
         params['page_size'] = page_size
         response = redash_client.get(cls.base_endpoint, params=params)
         page = 1
-        yield from cls.load_many(response['results'])
 
-        objects_yielded = page_size
-        while objects_yielded < response['count']:
-            page += 1
-            params['page'] = page
-            response = redash_client.get(cls.base_endpoint, params=params)
-            yield from cls.load_many(response['results'])
+        objects_yielded = 0
+        while True:
+            # The next page is requested in the background while the objects of the current page are being consumed
             objects_yielded += page_size
+            next_response = None
+            if objects_yielded < response['count']:
+                next_response = _pagination_executor.submit(redash_client.get, cls.base_endpoint,
+                                                            params={**params, 'page': page + 1})
+
+            try:
+                yield from cls.load_many(response['results'])
+            except GeneratorExit:
+                # The iteration was stopped early, so the next page isn't needed
+                if next_response is not None:
+                    next_response.cancel()
+
+                raise
+
+            if next_response is None:
+                return
+
+            page += 1
+            response = next_response.result()
 
 
 @dataclass
@@ -396,8 +566,14 @@ class Group(RedashEntity):
         response = redash_client.get(f'{self.object_endpoint}/data_sources')
         return DataSource.load_many(response)
 
-    def add_data_source(self, data_source_id: int):
+    def add_data_source(self, data_source_id: int, view_only: bool = False):
+        """
+        Adds a data source to the group. Redash adds data sources with full access and ignores view_only when adding,
+        so view only access is set with an additional request (only when it's requested)
+        """
         redash_client.post(f'{self.object_endpoint}/data_sources', json=dict(id=self.id, data_source_id=data_source_id))
+        if view_only:
+            self.set_data_source_access(data_source_id, view_only=True)
 
     def set_data_source_access(self, data_source_id: int, view_only: bool = True):
         redash_client.post(f'{self.object_endpoint}/data_sources/{data_source_id}', json=dict(view_only=view_only))